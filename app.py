@@ -1,19 +1,23 @@
-from fastapi import FastAPI, HTTPException, Query, Body
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Query, Body, Request, Response
+from fastapi.exception_handlers import request_validation_exception_handler
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field, field_validator, model_validator
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
-import mysql.connector
+import asyncio
+import asyncmy
+import hashlib
+import logging
+import orjson
 import os
 import re
+import time
+from collections import OrderedDict
 from functools import lru_cache
+from typing import Annotated
 
-app = FastAPI()
-
-
-# Cache for database connections
-@lru_cache(maxsize=1)
-def get_db_connection():
-    return mysql.connector.connect(**db_config)
-
+logger = logging.getLogger(__name__)
 
 # MySQL database configuration from environment variables
 db_config = {
@@ -23,146 +27,382 @@ db_config = {
     "database": os.getenv("DB_DATABASE"),
 }
 
+# Pool sizing per worker process. Recycle connections before the server's
+# wait_timeout closes them, which on managed MySQL is often far below 8h.
+# With a statement cache each connection prepares the positional %s
+# queries once and then executes them over the binary protocol, so the
+# server skips parsing and rows are decoded without text conversion
+pool_config = {
+    "minsize": int(os.getenv("DB_POOL_MINSIZE", "5")),
+    "maxsize": int(os.getenv("DB_POOL_MAXSIZE", "20")),
+    "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "3600")),
+    "stmt_cache_size": int(os.getenv("DB_STMT_CACHE_SIZE", "16")),
+}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One connection pool per worker process, shared by all requests
+    app.state.pool = await asyncmy.create_pool(
+        autocommit=True, **pool_config, **db_config
+    )
+    # Warm the symbol cache without holding up startup
+    app.state.warmup_task = asyncio.create_task(get_cached_symbols())
+    app.state.warmup_task.add_done_callback(log_warmup_result)
+    yield
+    app.state.warmup_task.cancel()
+    await asyncio.gather(app.state.warmup_task, return_exceptions=True)
+    app.state.pool.close()
+    await app.state.pool.wait_closed()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+
+# MySQL client errors for a connection lost between or during queries:
+# server has gone away, lost connection, lost connection during query
+connection_lost_errors = (2006, 2013, 2055)
+
+
+async def execute_query(query: str, params: tuple = ()) -> list:
+    # A pooled connection may have been dropped by the server while idle,
+    # so retry once on a fresh connection before giving up. Other errors,
+    # such as a query the server aborted, are not retried
+    for attempt in range(2):
+        try:
+            async with app.state.pool.acquire() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(query, params)
+                    return await cursor.fetchall()
+        except asyncmy.errors.OperationalError as e:
+            if attempt or e.args[0] not in connection_lost_errors:
+                raise
+
+
+# Queries currently running, keyed by (query, params)
+inflight_queries = {}
+
+
+async def execute_shared_query(query: str, params: tuple = ()) -> list:
+    # Concurrent requests for the same data share a single database
+    # round-trip instead of each running the identical query
+    key = (query, params)
+    task = inflight_queries.get(key)
+    if task is None:
+        task = asyncio.create_task(execute_query(query, params))
+        inflight_queries[key] = task
+        task.add_done_callback(lambda _: inflight_queries.pop(key, None))
+    # A disconnecting client must not cancel the query for the others
+    return await asyncio.shield(task)
+
+
 # Table name
-table_name = os.getenv("DB_LIQ_TABLENAME")
+table_name = os.getenv("DB_LIQ_TABLENAME", "binance_liqs")
+
+# Queries are built once at import, the table name is fixed per process
+# Only the bucket index is computed per row, bucket timestamps are derived
+# from it once per returned group. DIV gives an exact integer bucket, /
+# would round to four decimals and move a bucket's last milliseconds into
+# the next one. The sum is cast so the driver decodes floats, not Decimals
+liquidations_query = f"""
+SELECT (order_trade_time - %s) DIV %s AS bucket,
+       side,
+       CAST(SUM(usd_size) AS DOUBLE) AS cumulated_usd_size
+FROM {table_name}
+WHERE symbol = %s
+  AND order_trade_time BETWEEN %s AND %s
+GROUP BY bucket, side
+"""
+
+# Delivery contracts end in an expiry date (e.g. BTCUSDT_240927). They are
+# filtered out in Python over the distinct symbols rather than with a
+# REGEXP that MySQL would evaluate for every scanned row
+symbols_query = f"""
+SELECT DISTINCT symbol
+FROM {table_name}
+ORDER BY symbol
+"""
 
+# The symbol list changes on the order of days, so the DISTINCT scan is
+# only re-run once the cached list is older than this many seconds. The
+# list is kept already encoded so cache hits skip serialization entirely
+symbols_cache_ttl = int(os.getenv("SYMBOLS_CACHE_TTL", "300"))
+# Seconds to wait before retrying a failed refresh, the last good list is
+# served in the meantime
+symbols_retry_backoff = 30
+symbols_cache = {"body": None, "etag": None, "expires": 0.0}
+symbols_lock = asyncio.Lock()
 
+
+async def get_cached_symbols() -> tuple[bytes, str]:
+    if time.monotonic() < symbols_cache["expires"]:
+        return symbols_cache["body"], symbols_cache["etag"]
+
+    # Only one request refreshes an expired list, the others wait for it
+    async with symbols_lock:
+        if time.monotonic() >= symbols_cache["expires"]:
+            try:
+                results = await execute_query(symbols_query)
+            except Exception:
+                if symbols_cache["body"] is None:
+                    raise
+                logger.warning(
+                    "Symbol cache refresh failed, serving the previous list",
+                    exc_info=True,
+                )
+                symbols_cache["expires"] = time.monotonic() + symbols_retry_backoff
+            else:
+                symbols = [
+                    symbol
+                    for (symbol,) in results
+                    if symbol and not symbol[-1].isdigit()
+                ]
+                symbols_cache["body"], symbols_cache["etag"] = encode_json(symbols)
+                symbols_cache["expires"] = time.monotonic() + symbols_cache_ttl
+
+    return symbols_cache["body"], symbols_cache["etag"]
+
+
+# Liquidations are only ever appended, but can reach the table late. A
+# window counts as closed, and can no longer change, once its end is more
+# than this many seconds in the past
+liquidations_ingestion_lag = int(os.getenv("LIQUIDATIONS_INGESTION_LAG", "300"))
+
+# Responses for closed windows are kept encoded for a short while, keyed
+# by (symbol, timeframe, start, end), so repeated requests skip MySQL. The
+# cache is bounded by the total size of the bodies, least recently used
+# entries are evicted first, and bodies above the per-entry cap are not
+# cached at all. Entries expire so that rows arriving even later than the
+# ingestion lag are picked up again
+liquidations_cache_bytes = int(os.getenv("LIQUIDATIONS_CACHE_BYTES", "67108864"))
+liquidations_cache_entry_bytes = int(
+    os.getenv("LIQUIDATIONS_CACHE_ENTRY_BYTES", "1048576")
+)
+liquidations_cache_ttl = int(os.getenv("LIQUIDATIONS_CACHE_TTL", "60"))
+liquidations_cache = {"entries": OrderedDict(), "bytes": 0}
+
+
+def evict_cached_liquidations(key: tuple) -> None:
+    body, _, _ = liquidations_cache["entries"].pop(key)
+    liquidations_cache["bytes"] -= len(body)
+
+
+def get_cached_liquidations(key: tuple) -> tuple[bytes, str] | None:
+    entries = liquidations_cache["entries"]
+    cached = entries.get(key)
+    if cached is None:
+        return None
+    body, etag, expires = cached
+    if time.monotonic() >= expires:
+        evict_cached_liquidations(key)
+        return None
+    entries.move_to_end(key)
+    return body, etag
+
+
+def cache_liquidations(key: tuple, body: bytes, etag: str) -> None:
+    if len(body) > liquidations_cache_entry_bytes:
+        return
+    entries = liquidations_cache["entries"]
+    if key in entries:
+        evict_cached_liquidations(key)
+    entries[key] = (body, etag, time.monotonic() + liquidations_cache_ttl)
+    liquidations_cache["bytes"] += len(body)
+    while liquidations_cache["bytes"] > liquidations_cache_bytes:
+        evict_cached_liquidations(next(iter(entries)))
+
+
+def log_warmup_result(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("Symbol cache warm-up failed: %r", task.exception())
+
+
+# Milliseconds per timeframe unit suffix
+timeframe_units = {"m": 60 * 1000, "h": 3600 * 1000, "d": 86400 * 1000}
+# Longest accepted timeframe, one bucket per year
+max_timeframe_milliseconds = 365 * timeframe_units["d"]
+
+
+@lru_cache(maxsize=64)
 def convert_timeframe_to_milliseconds(timeframe: str) -> int:
-    timeframe = timeframe.lower()
-    if timeframe.endswith("m"):
-        return int(timeframe[:-1]) * 60 * 1000
-    elif timeframe.endswith("h"):
-        return int(timeframe[:-1]) * 3600 * 1000
-    elif timeframe.endswith("d"):
-        return int(timeframe[:-1]) * 86400 * 1000
-    else:
+    unit = timeframe_units.get(timeframe[-1:].lower())
+    if unit is None:
         raise ValueError("Invalid timeframe format")
+    return int(timeframe[:-1]) * unit
 
 
-class LiquidationRequest(BaseModel):
-    symbol: str
-    timeframe: str
-    start_timestamp_iso: str
-    end_timestamp_iso: str
+def parse_timestamp(timestamp: str) -> int:
+    timestamp = timestamp.strip()
+    if timestamp.lstrip("-").isdigit():
+        return int(timestamp)
+    return iso_to_milliseconds(timestamp)
 
 
-@app.get("/api/liquidations")
-async def get_liquidations(
-    symbol: str = Query(..., description="Symbol to filter by"),
-    timeframe: str = Query(..., description="Timeframe for aggregation"),
-    start_timestamp: str = Query(
-        ..., description="Start timestamp in ISO or Unix format"
-    ),
-    end_timestamp: str = Query(..., description="End timestamp in ISO or Unix format"),
-):
-    table_name = os.getenv("DB_LIQ_TABLENAME", "binance_liqs")
-    try:
-        if start_timestamp.isdigit():
-            start_timestamp = int(start_timestamp)
-        else:
-            start_timestamp = int(
-                datetime.fromisoformat(start_timestamp).timestamp() * 1000
+# Clients tend to reuse a small set of range boundaries, so only the
+# comparatively slow ISO path is memoized
+@lru_cache(maxsize=4096)
+def iso_to_milliseconds(timestamp: str) -> int:
+    return int(datetime.fromisoformat(timestamp).timestamp() * 1000)
+
+
+@lru_cache(maxsize=4096)
+def timestamp_to_iso(timestamp: int) -> str:
+    return datetime.fromtimestamp(timestamp / 1000, tz=timezone.utc).isoformat()
+
+
+def encode_json(content) -> tuple[bytes, str]:
+    # Content-derived ETag lets clients and proxies revalidate with a 304
+    # instead of downloading an unchanged body again
+    body = orjson.dumps(content)
+    return body, f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def json_response(
+    request: Request, body: bytes, etag: str, max_age: int, immutable: bool = False
+) -> Response:
+    cache_control = f"public, max-age={max_age}"
+    if immutable:
+        cache_control += ", immutable"
+    headers = {
+        "ETag": etag,
+        "Cache-Control": cache_control,
+        "Vary": "Accept-Encoding",
+    }
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+class LiquidationParams(BaseModel):
+    symbol: str = Field(description="Symbol to filter by")
+    # Converted to milliseconds, clients send e.g. 5m, 1h or 1d
+    timeframe: int = Field(
+        description="Timeframe for aggregation",
+        json_schema_extra={"type": "string"},
+    )
+    # Parsed to Unix milliseconds, but clients may send ISO strings
+    start_timestamp: int = Field(
+        description="Start timestamp in ISO or Unix format",
+        json_schema_extra={"type": "string"},
+    )
+    end_timestamp: int = Field(
+        description="End timestamp in ISO or Unix format",
+        json_schema_extra={"type": "string"},
+    )
+
+    @field_validator("symbol")
+    @classmethod
+    def normalize_symbol(cls, value: str) -> str:
+        # Binance symbols are stored upper-case
+        return value.upper()
+
+    @field_validator("timeframe", mode="before")
+    @classmethod
+    def parse_timeframe(cls, value: str) -> int:
+        try:
+            timeframe_milliseconds = convert_timeframe_to_milliseconds(value)
+        except (TypeError, ValueError):
+            timeframe_milliseconds = 0
+        if not 0 < timeframe_milliseconds <= max_timeframe_milliseconds:
+            raise ValueError(
+                "timeframe must be a positive number of minutes, hours or days up to 365d, e.g. 5m, 1h or 1d"
             )
+        return timeframe_milliseconds
 
-        if end_timestamp.isdigit():
-            end_timestamp = int(end_timestamp)
-        else:
-            end_timestamp = int(
-                datetime.fromisoformat(end_timestamp).timestamp() * 1000
+    @field_validator("start_timestamp", "end_timestamp", mode="before")
+    @classmethod
+    def parse_timestamps(cls, value: str) -> int:
+        try:
+            return parse_timestamp(value)
+        except (TypeError, ValueError):
+            raise ValueError(
+                "start_timestamp and end_timestamp must be valid Unix timestamps in miliseconds or datetime strings in ISO format"
             )
-    except (TypeError, ValueError):
-        raise HTTPException(
-            status_code=400,
-            detail="start_timestamp and end_timestamp must be valid Unix timestamps in miliseconds or datetime strings in ISO format",
-        )
 
-    timeframe_milliseconds = convert_timeframe_to_milliseconds(timeframe)
-    if start_timestamp < 0 or end_timestamp < 0:
-        raise HTTPException(
-            status_code=400,
-            detail="start_timestamp and end_timestamp must be non-negative integers",
-        )
+    @model_validator(mode="after")
+    def check_range(self) -> "LiquidationParams":
+        if self.start_timestamp < 0 or self.end_timestamp < 0:
+            raise ValueError(
+                "start_timestamp and end_timestamp must be non-negative integers"
+            )
+        if self.start_timestamp > self.end_timestamp:
+            raise ValueError("start_timestamp must be before end_timestamp")
+        return self
 
-    if start_timestamp > end_timestamp:
-        raise HTTPException(
-            status_code=400, detail="start_timestamp must be before end_timestamp"
+
+@app.exception_handler(RequestValidationError)
+async def validation_exception_handler(request: Request, exc: RequestValidationError):
+    # Failures raised only by our own validators keep the plain 400
+    # responses the API has always returned, anything else, such as a
+    # missing parameter, gets FastAPI's 422
+    errors = exc.errors()
+    if errors and all(error["type"] == "value_error" for error in errors):
+        return ORJSONResponse(
+            status_code=400, content={"detail": str(errors[0]["ctx"]["error"])}
         )
+    return await request_validation_exception_handler(request, exc)
+
+
+@app.get("/api/liquidations")
+async def get_liquidations(
+    request: Request, params: Annotated[LiquidationParams, Query()]
+):
+    start_timestamp = params.start_timestamp
+    end_timestamp = params.end_timestamp
+    timeframe_milliseconds = params.timeframe
+
+    closed = (
+        end_timestamp + liquidations_ingestion_lag * 1000 < time.time_ns() // 1_000_000
+    )
+    cache_key = (params.symbol, timeframe_milliseconds, start_timestamp, end_timestamp)
+    if closed:
+        cached = get_cached_liquidations(cache_key)
+        if cached is not None:
+            body, etag = cached
+            return json_response(request, body, etag, max_age=86400, immutable=True)
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    query = f"""
-    SELECT symbol, 
-           FLOOR((order_trade_time - %s) / %s) * %s + %s AS start_timestamp,
-           FLOOR((order_trade_time - %s) / %s) * %s + %s + %s AS end_timestamp,
-           side, 
-           SUM(usd_size) AS cumulated_usd_size
-    FROM {table_name}
-    WHERE LOWER(symbol) = %s 
-      AND order_trade_time BETWEEN %s AND %s
-    GROUP BY symbol, start_timestamp, end_timestamp, side;
-    """
-
-    cursor.execute(
-        query,
+    rows = await execute_shared_query(
+        liquidations_query,
         (
             start_timestamp,
             timeframe_milliseconds,
-            timeframe_milliseconds,
-            start_timestamp,
-            start_timestamp,
-            timeframe_milliseconds,
-            timeframe_milliseconds,
-            start_timestamp,
-            timeframe_milliseconds,
-            symbol.lower(),
+            params.symbol,
             start_timestamp,
             end_timestamp,
         ),
     )
-    results = [
-        {
-            "timestamp": result[1],
-            "timestamp_iso": datetime.fromtimestamp(
-                int(result[1]) / 1000, tz=timezone.utc
-            ).isoformat(),
-            "side": result[3],
-            "cumulated_usd_size": float(result[4]),
-        }
-        for result in cursor.fetchall()
-    ]
+    # Bucket timestamps repeat across sides and across requests for the
+    # same window, so their ISO strings are memoized
+    results = []
+    for bucket, side, cumulated_usd_size in rows:
+        timestamp = start_timestamp + bucket * timeframe_milliseconds
+        results.append(
+            {
+                "timestamp": timestamp,
+                "timestamp_iso": timestamp_to_iso(timestamp),
+                "side": side,
+                "cumulated_usd_size": cumulated_usd_size,
+            }
+        )
 
     if not results:
         raise HTTPException(
             status_code=404, detail="No data found for the given parameters"
         )
 
-    cursor.close()
-    # No need to close the connection as it's managed by the connection pool
+    body, etag = encode_json(results)
 
-    return results
+    # A closed window is cached for long by HTTP caches and briefly in
+    # process, anything more recent may still gain rows
+    if closed:
+        cache_liquidations(cache_key, body, etag)
+        return json_response(request, body, etag, max_age=86400, immutable=True)
+    return json_response(request, body, etag, max_age=60)
 
 
 @app.get("/api/symbols")
-async def get_symbols():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    query = """
-    SELECT DISTINCT symbol
-    FROM {}
-    WHERE symbol NOT REGEXP '[0-9]+$'
-    ORDER BY symbol
-    """.format(
-        table_name
-    )
-
-    cursor.execute(query)
-    results = cursor.fetchall()
-
-    symbols = [result[0] for result in results]
-
-    cursor.close()
-    # No need to close the connection as it's managed by the connection pool
+async def get_symbols(request: Request):
+    body, etag = await get_cached_symbols()
 
-    return symbols
+    return json_response(request, body, etag, max_age=symbols_cache_ttl)